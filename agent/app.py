@@ -1,11 +1,27 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import os, requests
+from fastapi.responses import Response, StreamingResponse
+import os, json, asyncio, httpx
 
 MIDDLEWARE_URL = os.getenv("MIDDLEWARE_URL", "http://middleware:8001/query")
+MIDDLEWARE_TIMEOUT = float(os.getenv("MIDDLEWARE_TIMEOUT", "120"))  # seconds without progress
+MIDDLEWARE_MAX_CONNECTIONS = int(os.getenv("MIDDLEWARE_MAX_CONNECTIONS", "200"))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "50"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))  # in-flight middleware calls per batch
+
+# Headers passed through to the middleware, and back from it; bodies are never decoded
+FORWARD_REQUEST_HEADERS = ("authorization", "content-type", "content-length", "accept", "accept-encoding")
+RELAY_RESPONSE_HEADERS = ("content-type", "content-length", "content-encoding")
 
 app = FastAPI()
 
+# One pooled keep-alive client for every call to the middleware
+middleware_client = httpx.AsyncClient(
+    timeout=httpx.Timeout(MIDDLEWARE_TIMEOUT, connect=5.0),
+    limits=httpx.Limits(max_connections=MIDDLEWARE_MAX_CONNECTIONS,
+                        max_keepalive_connections=MIDDLEWARE_MAX_CONNECTIONS),
+)
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -20,23 +36,76 @@ async def health_check():
     """Health check endpoint for deployment monitoring"""
     return {"status": "healthy", "service": "agent"}
 
+@app.on_event("shutdown")
+async def close_clients():
+    await middleware_client.aclose()
+
 @app.post("/query")
 async def forward_query(request: Request):
-    from fastapi import HTTPException
-    
-    payload = await request.json()
-    token = request.headers.get("Authorization")
-    headers = {"Authorization": token} if token else {}
-    
-    resp = requests.post(MIDDLEWARE_URL, json=payload, headers=headers)
-    
-    # Check if the middleware returned an error status
-    if resp.status_code != 200:
-        # Forward the error status and message from middleware
+    """Relay a query to the middleware and its response back as raw bytes.
+
+    JSON, NDJSON and Arrow results, and error responses, all pass through
+    unchanged with the middleware's status code; nothing is parsed here.
+    """
+    headers = {name: request.headers[name] for name in FORWARD_REQUEST_HEADERS if name in request.headers}
+    # Only let the middleware compress if the caller said it can decode that
+    headers.setdefault("accept-encoding", "identity")
+    req = middleware_client.build_request("POST", MIDDLEWARE_URL, content=await request.body(), headers=headers)
+    try:
+        resp = await middleware_client.send(req, stream=True)
+    except httpx.HTTPError as e:
+        print(f"DEBUG - Middleware request failed: {e!r}")
+        raise HTTPException(status_code=502, detail="Middleware unavailable")
+
+    async def relay():
         try:
-            error_detail = resp.json().get("detail", "Access denied")
-        except:
-            error_detail = "Access denied"
-        raise HTTPException(status_code=resp.status_code, detail=error_detail)
-    
-    return resp.json()
+            async for chunk in resp.aiter_raw():
+                yield chunk
+        finally:
+            await resp.aclose()
+
+    return StreamingResponse(relay(), status_code=resp.status_code,
+                             headers={name: resp.headers[name] for name in RELAY_RESPONSE_HEADERS if name in resp.headers})
+
+async def run_batch_item(payload, headers: dict, limit: asyncio.Semaphore) -> bytes:
+    """One batch entry as JSON bytes; the middleware's body is embedded without decoding it"""
+    if not isinstance(payload, dict):
+        return json.dumps({"status": 400, "error": {"detail": "Batch entries must be JSON objects"}}).encode()
+    if payload.get("stream") is True:
+        return json.dumps({"status": 400, "error": {"detail": "Streaming is not supported in batches"}}).encode()
+    async with limit:
+        try:
+            resp = await middleware_client.post(MIDDLEWARE_URL, json=payload, headers=headers)
+        except httpx.TimeoutException:
+            return json.dumps({"status": 504, "error": {"detail": "Middleware timed out"}}).encode()
+        except httpx.HTTPError as e:
+            print(f"DEBUG - Batch middleware request failed: {e!r}")
+            return json.dumps({"status": 502, "error": {"detail": "Middleware unavailable"}}).encode()
+    field = "result" if resp.status_code == 200 else "error"
+    if resp.headers.get("content-type", "").startswith("application/json"):
+        body = resp.content
+    else:
+        body = json.dumps({"detail": resp.text}).encode()
+    return b'{"status": %d, "%s": ' % (resp.status_code, field.encode()) + body + b"}"
+
+@app.post("/query/batch")
+async def forward_batch(request: Request):
+    """Run several /query payloads for one token concurrently.
+
+    Takes {"queries": [payload, ...]} and returns {"results": [...]} in the
+    same order, each entry holding the middleware's status code and either its
+    "result" or its "error". At most BATCH_CONCURRENCY entries are in flight at
+    once, so a slow entry only holds up its own slot.
+    """
+    body = await request.json()
+    queries = body.get("queries") if isinstance(body, dict) else None
+    if not isinstance(queries, list) or not queries:
+        raise HTTPException(status_code=400, detail="Expected a non-empty \"queries\" list")
+    if len(queries) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} queries per batch")
+
+    token = request.headers.get("Authorization")
+    headers = {"Authorization": token, "Accept": "application/json"} if token else {"Accept": "application/json"}
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results = await asyncio.gather(*(run_batch_item(payload, headers, limit) for payload in queries))
+    return Response(content=b'{"results": [' + b", ".join(results) + b"]}", media_type="application/json")
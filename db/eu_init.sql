@@ -60,3 +60,20 @@ INSERT INTO notes (patient_id, therapist_id, note, note_type, created_at) VALUES
 ('p105', 'pierre_therapist_eu', 'Patient making connections between past and present symptoms.', 'session', NOW() - INTERVAL '7 days'),
 ('p106', 'elena_therapist_eu', 'Adolescent therapy - identity and cultural integration issues.', 'session', NOW() - INTERVAL '7 days'),
 ('p107', 'anna_therapist_eu', 'PTSD treatment following workplace incident. EMDR recommended.', 'intake', NOW() - INTERVAL '2 days');
+
+-- Tell listeners (the middleware result cache) which table changed
+CREATE OR REPLACE FUNCTION notify_table_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('table_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER patients_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON patients
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
+
+CREATE TRIGGER notes_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON notes
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
+
+CREATE TRIGGER therapists_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON therapists
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
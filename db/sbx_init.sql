@@ -73,3 +73,20 @@ INSERT INTO research_metrics (metric_name, metric_value, patient_count, date_cal
 ('average_outcome_score', 84.2, 15, NOW()),
 ('completion_rate', 0.93, 15, NOW()),
 ('patient_satisfaction', 4.2, 15, NOW());
+
+-- Tell listeners (the middleware result cache) which table changed
+CREATE OR REPLACE FUNCTION notify_table_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('table_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER patients_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON patients
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
+
+CREATE TRIGGER notes_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON notes
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
+
+CREATE TRIGGER research_metrics_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON research_metrics
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
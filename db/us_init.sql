@@ -68,3 +68,20 @@ INSERT INTO notes (patient_id, therapist_id, note, note_type, created_at) VALUES
 ('p008', 'sarah_therapist', 'Crisis intervention session completed. Safety plan established.', 'crisis', NOW() - INTERVAL '1 day'),
 ('p009', 'mike_therapist', 'Initial consultation for addiction recovery. Motivational interviewing approach.', 'intake', NOW()),
 ('p010', 'lisa_therapist', 'Geriatric patient - cognitive assessment completed. Mild cognitive decline noted.', 'assessment', NOW());
+
+-- Tell listeners (the middleware result cache) which table changed
+CREATE OR REPLACE FUNCTION notify_table_change() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('table_changes', TG_TABLE_NAME);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER patients_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON patients
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
+
+CREATE TRIGGER notes_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON notes
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
+
+CREATE TRIGGER therapists_changed AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON therapists
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_table_change();
@@ -1,9 +1,30 @@
-import { useState } from 'react'
+import { useEffect, useState } from 'react'
 import useFlowStore from '../state/useFlowStore'
 
+const LOGGER_AUDIT_URL = 'http://localhost:9000/audit'
+
 export default function TracePanel() {
-  const { profile, trace, result } = useFlowStore()
+  const { token, profile, trace, result } = useFlowStore()
   const [activeTab, setActiveTab] = useState('result')
+  const [audit, setAudit] = useState({ records: [], loading: false, error: null })
+  const auditUser = profile?.preferred_username || profile?.sub
+
+  // Recent decisions for the signed-in user, served from the logger's audit index
+  useEffect(() => {
+    if (activeTab !== 'audit' || !auditUser || !token) return
+    let cancelled = false
+    setAudit(prev => ({ ...prev, loading: true, error: null }))
+    fetch(`${LOGGER_AUDIT_URL}?${new URLSearchParams({ user: auditUser, limit: '20' })}`, {
+      headers: { 'Authorization': `Bearer ${token}` },
+    })
+      .then(res => {
+        if (!res.ok) throw new Error(`HTTP ${res.status}`)
+        return res.json()
+      })
+      .then(data => !cancelled && setAudit({ records: data.records, loading: false, error: null }))
+      .catch(err => !cancelled && setAudit({ records: [], loading: false, error: err.message }))
+    return () => { cancelled = true }
+  }, [activeTab, auditUser, token, result])
 
   if (!trace && !result) {
     return (
@@ -21,6 +42,7 @@ export default function TracePanel() {
     { id: 'result', label: '📊 Result', icon: '📊' },
     { id: 'claims', label: '🎫 JWT Claims', icon: '🎫' },
     { id: 'trace', label: '🔍 Trace', icon: '🔍' },
+    { id: 'audit', label: '📜 Audit', icon: '📜' },
   ]
 
   const formatResult = () => {
@@ -262,6 +284,42 @@ export default function TracePanel() {
     )
   }
 
+  const formatAudit = () => {
+    if (!auditUser) return 'Sign in to see audit history'
+    if (audit.loading) return 'Loading audit history...'
+    if (audit.error) return `Audit log unavailable (${audit.error})`
+    if (audit.records.length === 0) return `No audit records for ${auditUser}`
+
+    return (
+      <div className="space-y-2">
+        <div className="text-sm text-gray-600">Last {audit.records.length} decisions for {auditUser}</div>
+        {audit.records.map((record, i) => {
+          const allowed = record.decision === 'allow'
+          return (
+            <div
+              key={i}
+              className={`border rounded-lg p-3 flex items-center space-x-3 ${
+                allowed ? 'bg-green-50 border-green-200 text-green-700' : 'bg-red-50 border-red-200 text-red-700'
+              }`}
+            >
+              <span className="text-xl">{allowed ? '✅' : '❌'}</span>
+              <div className="flex-1">
+                <div className="font-medium">
+                  {record.payload?.action || 'read'} {record.payload?.resource} on {record.payload?.db || 'unknown db'}
+                </div>
+                <div className="text-sm opacity-80">
+                  {record.timestamp ? new Date(record.timestamp).toLocaleString() : 'Unknown time'}
+                  {record.payload?.user?.role && ` · ${record.payload.user.role}`}
+                </div>
+              </div>
+              <div className="text-sm font-medium capitalize">{record.decision}</div>
+            </div>
+          )
+        })}
+      </div>
+    )
+  }
+
   return (
     <div className="backdrop-blur bg-white/20 rounded-2xl shadow-xl border border-white/30">
       <div className="border-b border-white/20">
@@ -287,6 +345,7 @@ export default function TracePanel() {
         {activeTab === 'result' && formatResult()}
         {activeTab === 'claims' && formatClaims()}
         {activeTab === 'trace' && formatTrace()}
+        {activeTab === 'audit' && formatAudit()}
       </div>
     </div>
   )
@@ -1,8 +1,40 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-import json, os
+import json, os, time, threading, asyncio, datetime, queue, sqlite3, hashlib, httpx, jwt
+from collections import deque, OrderedDict
+
+LOG_DIR = os.getenv("LOG_DIR", "/logs")
+# Always points at the segment being appended to, so `tail -F` keeps working
+LOG_FILE = os.path.join(LOG_DIR, "access.log")
+SEGMENT_DIR = os.path.join(LOG_DIR, "segments")
+MANIFEST_FILE = os.path.join(LOG_DIR, "manifest.json")
+INDEX_FILE = os.path.join(LOG_DIR, "index.sqlite")
+
+LOG_SEGMENT_MAX_BYTES = int(os.getenv("LOG_SEGMENT_MAX_BYTES", str(64 * 1024 * 1024)))
+LOG_SEGMENT_MAX_AGE = float(os.getenv("LOG_SEGMENT_MAX_AGE", "3600"))  # seconds
+LOG_FSYNC_EVERY = int(os.getenv("LOG_FSYNC_EVERY", "1000"))  # records; 0 disables the count trigger
+LOG_FSYNC_INTERVAL = float(os.getenv("LOG_FSYNC_INTERVAL_MS", "200")) / 1000
+# Hold acknowledgements until the records are fsynced instead of just written
+LOG_SYNC_ACK = os.getenv("LOG_SYNC_ACK", "false").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "100000"))  # records waiting for the writer
+THROUGHPUT_WINDOW = 60.0  # seconds
+AUDIT_QUERY_MAX_LIMIT = int(os.getenv("AUDIT_QUERY_MAX_LIMIT", "1000"))
+# Roles that may read every user's audit history; everyone else only sees their own
+AUDIT_ADMIN_ROLES = set(os.getenv("AUDIT_ADMIN_ROLES", "admin").split(","))
+
+# JWT verification against Keycloak's signing keys, as in the middleware
+KEYCLOAK_JWKS_URL = os.getenv(
+    "KEYCLOAK_JWKS_URL", "http://auth-service:8080/realms/zerotrust/protocol/openid-connect/certs"
+)
+JWT_VERIFY_SIGNATURE = os.getenv("JWT_VERIFY_SIGNATURE", "true").lower() == "true"
+JWT_ALGORITHMS = os.getenv("JWT_ALGORITHMS", "RS256").split(",")
+JWT_AUDIENCE = os.getenv("JWT_AUDIENCE")
+JWT_ISSUER = os.getenv("JWT_ISSUER")
+JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", "300"))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "10"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "1000"))
+DEFAULT_ROLES = ["default-roles-zerotrust", "offline_access", "uma_authorization"]
 
-LOG_FILE = "/logs/access.log"
 app = FastAPI()
 
 # Add CORS middleware
@@ -14,10 +46,690 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+def utc_now() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def settle(fut: asyncio.Future, result):
+    """Resolve a request's future from the loop thread; the client may have gone away"""
+    if fut.done():
+        return
+    if isinstance(result, BaseException):
+        fut.set_exception(result)
+    else:
+        fut.set_result(result)
+
+
+def epoch_ms(stamp) -> int:
+    """Milliseconds since the epoch for an ISO timestamp, naive ones taken as UTC"""
+    if not isinstance(stamp, str):
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(stamp.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def index_fields(record: dict) -> dict:
+    """The indexed attributes of an audit record as logged by the middleware"""
+    payload = record.get("payload") if isinstance(record.get("payload"), dict) else {}
+    user = payload.get("user") if isinstance(payload.get("user"), dict) else {}
+    return {
+        "user": user.get("preferred_username") or user.get("sub"),
+        "role": user.get("role"),
+        "db": payload.get("db"),
+        "decision": record.get("decision"),
+    }
+
+
+class AuditIndex:
+    """Secondary indexes over the log segments, kept in SQLite next to them.
+
+    Each record gets one row holding its segment, byte offset and length, its
+    timestamp and dictionary-encoded user, role, db and decision. Every field
+    has a composite (field, ts) index, so a filtered time-range query is a
+    B-tree seek plus a range scan however large the log grows, and only the
+    matching records are read back from the segment files. The segments stay
+    the source of truth: anything missing from the index is re-read from them
+    on startup.
+    """
+
+    FIELDS = ("user", "role", "db", "decision")
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db = None  # used by the writer thread only
+        self._terms = {}  # (field, value) -> term id
+
+    def open(self):
+        db = sqlite3.connect(self.path, check_same_thread=False, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("""CREATE TABLE IF NOT EXISTS terms (
+            id INTEGER PRIMARY KEY,
+            field TEXT NOT NULL,
+            value TEXT NOT NULL,
+            UNIQUE (field, value)
+        )""")
+        db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            ts INTEGER,
+            segment INTEGER NOT NULL,
+            pos INTEGER NOT NULL,
+            len INTEGER NOT NULL,
+            user_id INTEGER,
+            role_id INTEGER,
+            db_id INTEGER,
+            decision_id INTEGER
+        )""")
+        db.execute("CREATE INDEX IF NOT EXISTS entries_ts ON entries (ts)")
+        for field in self.FIELDS:
+            db.execute(f"CREATE INDEX IF NOT EXISTS entries_{field} ON entries ({field}_id, ts)")
+        # How far into each segment the index reaches
+        db.execute("CREATE TABLE IF NOT EXISTS indexed (segment INTEGER PRIMARY KEY, bytes INTEGER NOT NULL)")
+        db.commit()
+        self._terms = {(field, value): term for term, field, value in db.execute("SELECT id, field, value FROM terms")}
+        self._db = db
+
+    def _term(self, field: str, value):
+        if value is None:
+            return None
+        key = (field, str(value))
+        term = self._terms.get(key)
+        if term is None:
+            term = self._db.execute("INSERT INTO terms (field, value) VALUES (?, ?)", key).lastrowid
+            self._terms[key] = term
+        return term
+
+    def add(self, seq: int, pos: int, records: list, lengths: list):
+        """Index records appended to segment ``seq`` starting at byte ``pos``"""
+        rows = []
+        for record, length in zip(records, lengths):
+            fields = index_fields(record)
+            rows.append((epoch_ms(record.get("timestamp")), seq, pos, length,
+                         *(self._term(field, fields[field]) for field in self.FIELDS)))
+            pos += length
+        self._db.executemany("INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._db.execute("INSERT OR REPLACE INTO indexed (segment, bytes) VALUES (?, ?)", (seq, pos))
+        self._db.commit()
+
+    def catch_up(self, segment: dict):
+        """Index whatever part of a segment the index doesn't cover yet"""
+        seq, size = segment["seq"], segment["bytes"]
+        row = self._db.execute("SELECT bytes FROM indexed WHERE segment = ?", (seq,)).fetchone()
+        done = row[0] if row else 0
+        if done > size:
+            # The index got ahead of a segment trimmed after a crash
+            self._db.execute("DELETE FROM entries WHERE segment = ? AND pos >= ?", (seq, size))
+            self._db.execute("UPDATE indexed SET bytes = ? WHERE segment = ?", (size, seq))
+            self._db.commit()
+            return
+        if done == size:
+            return
+        with open(os.path.join(SEGMENT_DIR, segment["name"]), "rb") as f:
+            f.seek(done)
+            lines = f.read(size - done).splitlines(keepends=True)
+        records = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = {}
+            records.append(record if isinstance(record, dict) else {})
+        self.add(seq, done, records, [len(line) for line in lines])
+        print(f"DEBUG - Indexed {len(records)} records of {segment['name']}")
+
+    def query(self, start: int, end: int, filters: dict, limit: int, newest_first: bool) -> list:
+        """(segment, pos, len) of matching records, via a separate read-only connection"""
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, timeout=5)
+        try:
+            where, params = [], []
+            for field, value in filters.items():
+                term = db.execute("SELECT id FROM terms WHERE field = ? AND value = ?", (field, value)).fetchone()
+                if term is None:
+                    return []
+                where.append(f"{field}_id = ?")
+                params.append(term[0])
+            if start is not None:
+                where.append("ts >= ?")
+                params.append(start)
+            if end is not None:
+                where.append("ts < ?")
+                params.append(end)
+            sql = "SELECT segment, pos, len FROM entries"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+            sql += f" ORDER BY ts {'DESC' if newest_first else 'ASC'} LIMIT ?"
+            return db.execute(sql, params + [limit]).fetchall()
+        finally:
+            db.close()
+
+
+class SegmentWriter:
+    """Single writer for the audit log.
+
+    Requests queue their records and wait until the writer thread has appended
+    them. The thread drains everything queued into one write (group commit),
+    fsyncs every LOG_FSYNC_EVERY records or LOG_FSYNC_INTERVAL_MS, whichever
+    comes first, and rotates into a new segment file once the current one
+    reaches LOG_SEGMENT_MAX_BYTES or LOG_SEGMENT_MAX_AGE. manifest.json lists
+    every segment with its record count, size and time range.
+
+    An error the thread can't attribute to one write (a failed fsync, rotation
+    or manifest update) fails every waiting request and marks the writer
+    failed; /log then answers 503 until the service is restarted.
+    """
+
+    STOP = object()
+
+    def __init__(self, index: AuditIndex):
+        self.index = index
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._thread = None
+        self._segments = []
+        self._file = None
+        self._opened_at = 0.0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._durable_waiters = []
+        self._failed = None
+        self._window = deque()  # (monotonic time, records) per group
+        self._stats = {"records": 0, "bytes": 0, "groups": 0, "fsyncs": 0, "rotations": 0,
+                       "rejected": 0, "write_errors": 0, "index_errors": 0}
+
+    def start(self):
+        os.makedirs(SEGMENT_DIR, exist_ok=True)
+        self._load_manifest()
+        self._adopt_legacy_log()
+        self.index.open()
+        for segment in self._segments:
+            self.index.catch_up(segment)
+        self._thread = threading.Thread(target=self._run, name="segment-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(self.STOP)
+            self._thread.join()
+
+    async def append(self, records: list) -> int:
+        with self._lock:
+            if self._failed is not None:
+                raise HTTPException(status_code=503, detail="Audit log writer failed, not accepting records")
+            if self._queued + len(records) > LOG_QUEUE_SIZE:
+                self._stats["rejected"] += len(records)
+                raise HTTPException(status_code=503, detail="Log writer is saturated, retry later")
+            self._queued += len(records)
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._queue.put((records, loop, fut))
+        return await fut
+
+    # --- writer thread ---
+
+    def _run(self):
+        while True:
+            item = self._next(self._sync_deadline())
+            group = []
+            stopping = False
+            while item is not None:
+                if item is self.STOP:
+                    stopping = True
+                    break
+                group.append(item)
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            try:
+                if self._failed is not None:
+                    # Queued before the failure was noticed
+                    self._fail(group)
+                    if stopping:
+                        return
+                    continue
+                if group:
+                    self._write_group(group)
+                if self._unsynced and (stopping or time.monotonic() >= self._last_sync + LOG_FSYNC_INTERVAL):
+                    self._sync()
+                if stopping:
+                    self._seal()
+                    return
+                if self._file is not None and time.monotonic() - self._opened_at >= LOG_SEGMENT_MAX_AGE:
+                    self._seal()
+            except Exception as e:
+                self._failed = repr(e)
+                print(f"DEBUG - Audit log writer failed, rejecting records until restart: {e!r}")
+                self._fail(group)
+                if stopping:
+                    return
+            finally:
+                with self._lock:
+                    self._queued -= sum(len(batch) for batch, _, _ in group)
+
+    def _fail(self, group: list):
+        """Fail every request still waiting, including those waiting on an fsync"""
+        error = HTTPException(status_code=503, detail="Audit log writer failed")
+        for loop, fut, _ in self._durable_waiters:
+            loop.call_soon_threadsafe(settle, fut, error)
+        for _, loop, fut in group:
+            loop.call_soon_threadsafe(settle, fut, error)
+        self._durable_waiters = []
+        self._unsynced = 0
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
+
+    def _sync_deadline(self) -> float:
+        if not self._unsynced:
+            return LOG_FSYNC_INTERVAL
+        return max(0.0, self._last_sync + LOG_FSYNC_INTERVAL - time.monotonic())
+
+    def _next(self, timeout: float):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def _write_group(self, group: list):
+        records = [record for batch, _, _ in group for record in batch]
+        try:
+            lines = [(json.dumps(record) + "\n").encode() for record in records]
+            data = b"".join(lines)
+            if self._file is not None and self._file.tell() >= LOG_SEGMENT_MAX_BYTES:
+                self._seal()
+            if self._file is None:
+                self._open_segment()
+            pos = self._file.tell()
+            self._file.write(data)
+            self._file.flush()
+        except OSError as e:
+            self._stats["write_errors"] += 1
+            print(f"DEBUG - Audit log write of {len(records)} records failed: {e!r}")
+            for _, loop, fut in group:
+                loop.call_soon_threadsafe(settle, fut, HTTPException(status_code=500, detail="Audit log write failed"))
+            return
+
+        segment = self._segments[-1]
+        segment["records"] += len(records)
+        segment["bytes"] += len(data)
+        stamps = [record["timestamp"] for record in records if isinstance(record.get("timestamp"), str)]
+        if stamps:
+            first, last = min(stamps), max(stamps)
+            segment["first_ts"] = min(segment["first_ts"] or first, first)
+            segment["last_ts"] = max(segment["last_ts"] or last, last)
+
+        try:
+            self.index.add(segment["seq"], pos, records, [len(line) for line in lines])
+        except sqlite3.Error as e:
+            # The segment has the records; the index catches up from it on the next start
+            self._stats["index_errors"] += 1
+            print(f"DEBUG - Audit index update failed: {e}")
+
+        self._unsynced += len(records)
+        self._stats["records"] += len(records)
+        self._stats["bytes"] += len(data)
+        self._stats["groups"] += 1
+        now = time.monotonic()
+        with self._lock:
+            self._window.append((now, len(records)))
+            while self._window and self._window[0][0] < now - THROUGHPUT_WINDOW:
+                self._window.popleft()
+
+        for batch, loop, fut in group:
+            if LOG_SYNC_ACK:
+                self._durable_waiters.append((loop, fut, len(batch)))
+            else:
+                loop.call_soon_threadsafe(settle, fut, len(batch))
+        if LOG_FSYNC_EVERY and self._unsynced >= LOG_FSYNC_EVERY:
+            self._sync()
+
+    def _sync(self):
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._stats["fsyncs"] += 1
+        for loop, fut, count in self._durable_waiters:
+            loop.call_soon_threadsafe(settle, fut, count)
+        self._durable_waiters = []
+
+    def _open_segment(self):
+        seq = self._segments[-1]["seq"] + 1 if self._segments else 1
+        name = f"segment-{seq:08d}.ndjson"
+        self._file = open(os.path.join(SEGMENT_DIR, name), "ab")
+        self._opened_at = time.monotonic()
+        self._segments.append({"seq": seq, "name": name, "created_at": utc_now(), "sealed_at": None,
+                               "records": 0, "bytes": 0, "first_ts": None, "last_ts": None})
+        self._write_manifest()
+        tmp = LOG_FILE + ".tmp"
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(os.path.join("segments", name), tmp)
+        os.replace(tmp, LOG_FILE)
+
+    def _seal(self):
+        if self._file is None:
+            return
+        self._sync()
+        self._file.close()
+        self._file = None
+        self._segments[-1]["sealed_at"] = utc_now()
+        self._stats["rotations"] += 1
+        self._write_manifest()
+
+    def _write_manifest(self):
+        tmp = MANIFEST_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"segments": self._segments}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, MANIFEST_FILE)
+
+    # --- startup recovery ---
+
+    def _load_manifest(self):
+        if os.path.exists(MANIFEST_FILE):
+            with open(MANIFEST_FILE) as f:
+                self._segments = json.load(f)["segments"]
+        if self._segments and self._segments[-1]["sealed_at"] is None:
+            # Crashed while appending: the manifest's counts are stale, recount from the file
+            self._recount(self._segments[-1])
+            self._segments[-1]["sealed_at"] = utc_now()
+            self._write_manifest()
+
+    def _adopt_legacy_log(self):
+        """Move a pre-segment access.log into the segment list instead of replacing it"""
+        if not os.path.isfile(LOG_FILE) or os.path.islink(LOG_FILE):
+            return
+        seq = self._segments[-1]["seq"] + 1 if self._segments else 1
+        name = f"segment-{seq:08d}.ndjson"
+        os.replace(LOG_FILE, os.path.join(SEGMENT_DIR, name))
+        segment = {"seq": seq, "name": name, "created_at": utc_now(), "sealed_at": utc_now(),
+                   "records": 0, "bytes": 0, "first_ts": None, "last_ts": None}
+        self._recount(segment)
+        self._segments.append(segment)
+        self._write_manifest()
+        print(f"DEBUG - Adopted legacy access.log as {name} ({segment['records']} records)")
+
+    def _recount(self, segment: dict):
+        path = os.path.join(SEGMENT_DIR, segment["name"])
+        segment.update({"records": 0, "bytes": 0, "first_ts": None, "last_ts": None})
+        if not os.path.exists(path):
+            return
+        with open(path, "rb+") as f:
+            data = f.read()
+            end = data.rfind(b"\n") + 1
+            if end < len(data):
+                f.truncate(end)  # torn final write
+        for line in data[:end].splitlines():
+            segment["records"] += 1
+            try:
+                stamp = json.loads(line).get("timestamp")
+            except (json.JSONDecodeError, AttributeError):
+                continue
+            if isinstance(stamp, str):
+                segment["first_ts"] = min(segment["first_ts"] or stamp, stamp)
+                segment["last_ts"] = max(segment["last_ts"] or stamp, stamp)
+        segment["bytes"] = end
+
+    def read_records(self, locations: list) -> list:
+        """Read records back from their segments, opening each segment once"""
+        names = {segment["seq"]: segment["name"] for segment in self._segments}
+        records = [None] * len(locations)
+        by_segment = {}
+        for i, (seq, pos, length) in enumerate(locations):
+            by_segment.setdefault(seq, []).append((pos, length, i))
+        for seq, entries in by_segment.items():
+            with open(os.path.join(SEGMENT_DIR, names[seq]), "rb") as f:
+                for pos, length, i in sorted(entries):
+                    f.seek(pos)
+                    records[i] = json.loads(f.read(length))
+        return records
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            recent = sum(count for at, count in self._window if at >= now - THROUGHPUT_WINDOW)
+            queued = self._queued
+        groups = self._stats["groups"]
+        return {
+            **self._stats,
+            "records_per_group": round(self._stats["records"] / groups, 1) if groups else 0.0,
+            "records_per_sec": round(recent / THROUGHPUT_WINDOW, 1),
+            "queued": queued,
+            "failed": self._failed,
+            "segments": len(self._segments),
+            "active_segment": self._segments[-1]["name"] if self._file is not None else None,
+            "fsync_every": LOG_FSYNC_EVERY,
+            "fsync_interval_ms": LOG_FSYNC_INTERVAL * 1000,
+            "sync_ack": LOG_SYNC_ACK,
+        }
+
+
+writer = SegmentWriter(AuditIndex(INDEX_FILE))
+
+
+class TokenVerifier:
+    """Verifies JWTs against Keycloak's JWKS and caches the verified claims.
+
+    Signing keys are cached for ``JWKS_CACHE_TTL`` seconds and refetched
+    early when a token names an unknown ``kid`` (key rotation), at most once
+    per ``JWKS_MIN_REFRESH_INTERVAL``. Verified claims, together with the
+    value computed by ``derive``, are cached per token digest until ``exp``.
+
+    The original lives in middleware/app.py. logger/app.py and
+    mcp-server/app.py carry identical copies because each image is built from
+    its own directory; change all three together.
+    """
+
+    def __init__(self, jwks_url: str, client: httpx.AsyncClient, derive=None):
+        self.jwks_url = jwks_url
+        self.client = client
+        self.derive = derive
+        self._keys = {}
+        self._keys_fetched_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._claims = OrderedDict()  # sha256(token) -> (claims, derived, exp)
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "rejected": 0, "jwks_refreshes": 0}
+
+    async def _refresh_keys(self):
+        resp = await self.client.get(self.jwks_url)
+        resp.raise_for_status()
+        keys = {}
+        for jwk in resp.json().get("keys", []):
+            if jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK.from_dict(jwk)
+            except jwt.PyJWTError:
+                continue
+        self._keys = keys
+        self._keys_fetched_at = time.monotonic()
+        self._stats["jwks_refreshes"] += 1
+
+    async def _signing_key(self, kid):
+        stale = time.monotonic() - self._keys_fetched_at > JWKS_CACHE_TTL
+        if kid not in self._keys or stale:
+            async with self._refresh_lock:
+                since_refresh = time.monotonic() - self._keys_fetched_at
+                if since_refresh > JWKS_CACHE_TTL or (kid not in self._keys and since_refresh > JWKS_MIN_REFRESH_INTERVAL):
+                    await self._refresh_keys()
+        key = self._keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid}")
+        return key
+
+    def cached(self, token: str):
+        """Return ``(claims, derived)`` if the token was verified and hasn't expired, else None"""
+        digest = hashlib.sha256(token.encode()).digest()
+        entry = self._claims.get(digest)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] <= time.time():
+            del self._claims[digest]
+            self._stats["expired"] += 1
+            return None
+        self._claims.move_to_end(digest)
+        return entry[0], entry[1]
+
+    async def verify(self, token: str):
+        """Return ``(claims, derived)`` for a valid token, raising jwt.InvalidTokenError otherwise"""
+        entry = self.cached(token)
+        if entry is not None:
+            self._stats["hits"] += 1
+            return entry
+        self._stats["misses"] += 1
+
+        try:
+            if JWT_VERIFY_SIGNATURE:
+                header = jwt.get_unverified_header(token)
+                key = await self._signing_key(header.get("kid"))
+                claims = jwt.decode(
+                    token,
+                    key.key,
+                    algorithms=JWT_ALGORITHMS,
+                    audience=JWT_AUDIENCE,
+                    issuer=JWT_ISSUER,
+                    options={"require": ["exp"], "verify_aud": JWT_AUDIENCE is not None},
+                )
+            else:
+                claims = jwt.decode(token, options={"verify_signature": False})
+        except jwt.InvalidTokenError:
+            self._stats["rejected"] += 1
+            raise
+
+        derived = self.derive(claims) if self.derive else None
+        if TOKEN_CACHE_SIZE > 0:
+            self._claims[hashlib.sha256(token.encode()).digest()] = (claims, derived, claims.get("exp"))
+            while len(self._claims) > TOKEN_CACHE_SIZE:
+                self._claims.popitem(last=False)
+        return claims, derived
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "size": len(self._claims),
+            "signing_keys": len(self._keys),
+            "verify_signature": JWT_VERIFY_SIGNATURE,
+        }
+
+
+http_client = httpx.AsyncClient(timeout=5.0)
+token_verifier = TokenVerifier(KEYCLOAK_JWKS_URL, http_client)
+
+
+def token_roles(claims: dict) -> set:
+    """Application roles in the token's realm and client role claims"""
+    roles = set(claims.get("realm_access", {}).get("roles", []))
+    for access in claims.get("resource_access", {}).values():
+        roles.update(access.get("roles", []))
+    if "role" in claims:
+        roles.add(claims["role"])
+    return roles - set(DEFAULT_ROLES)
+
+
+async def get_user(request: Request) -> dict:
+    """Verify the bearer token on the request and return its claims"""
+    auth = request.headers.get("Authorization")
+    if not auth:
+        raise HTTPException(status_code=401, detail="Missing token")
+    try:
+        claims, _ = await token_verifier.verify(auth.split(" ")[-1])
+        return claims
+    except jwt.InvalidTokenError as e:
+        print(f"DEBUG - Token rejected: {e}")
+        raise HTTPException(status_code=401, detail="Invalid token")
+    except httpx.HTTPError as e:
+        print(f"DEBUG - Could not fetch signing keys: {e}")
+        raise HTTPException(status_code=503, detail="Unable to verify token")
+
+
+@app.on_event("startup")
+async def start_writer():
+    writer.start()
+
+
+@app.on_event("shutdown")
+async def stop_writer():
+    await asyncio.to_thread(writer.close)
+    await http_client.aclose()
+
+
+def stamp(records: list) -> list:
+    now = utc_now()
+    for record in records:
+        if not isinstance(record, dict):
+            raise HTTPException(status_code=400, detail="Audit records must be JSON objects")
+        record.setdefault("timestamp", now)
+    return records
+
+
 @app.post("/log")
 async def write_log(request: Request):
     data = await request.json()
-    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
-    with open(LOG_FILE, "a") as f:
-        f.write(json.dumps(data) + "\n")
-    return {"status": "ok"}
+    # The middleware ships batches as a JSON list; a single object is still accepted
+    records = stamp(data if isinstance(data, list) else [data])
+    written = await writer.append(records)
+    return {"status": "ok", "written": written}
+
+
+@app.post("/log/bulk")
+async def write_log_bulk(request: Request):
+    """Ingest an NDJSON body, one audit record per line"""
+    records = []
+    for number, line in enumerate((await request.body()).splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line))
+        except json.JSONDecodeError:
+            raise HTTPException(status_code=400, detail=f"Line {number} is not valid JSON")
+    written = await writer.append(stamp(records)) if records else 0
+    return {"status": "ok", "written": written}
+
+
+@app.get("/metrics")
+async def metrics():
+    return {"writer": writer.stats(), "tokens": token_verifier.stats()}
+
+
+@app.get("/audit")
+async def query_audit(request: Request, start: str = None, end: str = None, user: str = None, role: str = None,
+                      db: str = None, decision: str = None, limit: int = 100, order: str = "desc"):
+    """Audit records in [start, end) matching every given filter, newest first by default.
+
+    Requires a bearer token; callers without an admin role only see their own records.
+    """
+    claims = await get_user(request)
+    if not token_roles(claims) & AUDIT_ADMIN_ROLES:
+        caller = claims.get("preferred_username") or claims.get("sub")
+        if caller is None or (user is not None and user != caller):
+            raise HTTPException(status_code=403, detail="Only your own audit records can be read")
+        user = caller
+    bounds = {}
+    for name, value in (("start", start), ("end", end)):
+        if value is not None:
+            bounds[name] = epoch_ms(value)
+            if bounds[name] is None:
+                raise HTTPException(status_code=400, detail=f"{name} must be an ISO 8601 timestamp")
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order must be asc or desc")
+    limit = max(1, min(limit, AUDIT_QUERY_MAX_LIMIT))
+    filters = {field: value for field, value in
+               (("user", user), ("role", role), ("db", db), ("decision", decision)) if value is not None}
+
+    def run():
+        locations = writer.index.query(bounds.get("start"), bounds.get("end"), filters, limit, order == "desc")
+        return writer.read_records(locations)
+
+    records = await asyncio.to_thread(run)
+    return {"records": records, "count": len(records), "truncated": len(records) == limit}
@@ -7,10 +7,13 @@ Requires valid JWT authentication for all operations
 """
 
 import asyncio
+import hashlib
 import json
 import logging
 import os
 import re
+import time
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional
 import httpx
 import jwt
@@ -36,6 +39,19 @@ logger = logging.getLogger("zerotrust-mcp")
 
 # Configuration - Middleware proxy
 MIDDLEWARE_URL = os.getenv("MIDDLEWARE_URL", "http://localhost:8001/query")
+MIDDLEWARE_AUTHZ_URL = os.getenv("MIDDLEWARE_AUTHZ_URL", MIDDLEWARE_URL.rsplit("/", 1)[0] + "/authorize")
+
+# Configuration - JWT verification against Keycloak's signing keys
+KEYCLOAK_JWKS_URL = os.getenv(
+    "KEYCLOAK_JWKS_URL", "http://auth-service:8080/realms/zerotrust/protocol/openid-connect/certs"
+)
+JWT_VERIFY_SIGNATURE = os.getenv("JWT_VERIFY_SIGNATURE", "true").lower() == "true"
+JWT_ALGORITHMS = os.getenv("JWT_ALGORITHMS", "RS256").split(",")
+JWT_AUDIENCE = os.getenv("JWT_AUDIENCE")
+JWT_ISSUER = os.getenv("JWT_ISSUER")
+JWKS_CACHE_TTL = float(os.getenv("JWKS_CACHE_TTL", "300"))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "10"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
 
 # FastAPI app for HTTP demo endpoint
 app = FastAPI(title="Zero Trust MCP Server")
@@ -49,32 +65,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+class TokenVerifier:
+    """Verifies JWTs against Keycloak's JWKS and caches the verified claims.
+
+    Signing keys are cached for ``JWKS_CACHE_TTL`` seconds and refetched
+    early when a token names an unknown ``kid`` (key rotation), at most once
+    per ``JWKS_MIN_REFRESH_INTERVAL``. Verified claims, together with the
+    value computed by ``derive``, are cached per token digest until ``exp``.
+
+    The original lives in middleware/app.py. logger/app.py and
+    mcp-server/app.py carry identical copies because each image is built from
+    its own directory; change all three together.
+    """
+
+    def __init__(self, jwks_url: str, client: httpx.AsyncClient, derive=None):
+        self.jwks_url = jwks_url
+        self.client = client
+        self.derive = derive
+        self._keys = {}
+        self._keys_fetched_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._claims = OrderedDict()  # sha256(token) -> (claims, derived, exp)
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "rejected": 0, "jwks_refreshes": 0}
+
+    async def _refresh_keys(self):
+        resp = await self.client.get(self.jwks_url)
+        resp.raise_for_status()
+        keys = {}
+        for jwk in resp.json().get("keys", []):
+            if jwk.get("use", "sig") != "sig":
+                continue
+            try:
+                keys[jwk.get("kid")] = jwt.PyJWK.from_dict(jwk)
+            except jwt.PyJWTError:
+                continue
+        self._keys = keys
+        self._keys_fetched_at = time.monotonic()
+        self._stats["jwks_refreshes"] += 1
+
+    async def _signing_key(self, kid):
+        stale = time.monotonic() - self._keys_fetched_at > JWKS_CACHE_TTL
+        if kid not in self._keys or stale:
+            async with self._refresh_lock:
+                since_refresh = time.monotonic() - self._keys_fetched_at
+                if since_refresh > JWKS_CACHE_TTL or (kid not in self._keys and since_refresh > JWKS_MIN_REFRESH_INTERVAL):
+                    await self._refresh_keys()
+        key = self._keys.get(kid)
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid}")
+        return key
+
+    def cached(self, token: str):
+        """Return ``(claims, derived)`` if the token was verified and hasn't expired, else None"""
+        digest = hashlib.sha256(token.encode()).digest()
+        entry = self._claims.get(digest)
+        if entry is None:
+            return None
+        if entry[2] is not None and entry[2] <= time.time():
+            del self._claims[digest]
+            self._stats["expired"] += 1
+            return None
+        self._claims.move_to_end(digest)
+        return entry[0], entry[1]
+
+    async def verify(self, token: str):
+        """Return ``(claims, derived)`` for a valid token, raising jwt.InvalidTokenError otherwise"""
+        entry = self.cached(token)
+        if entry is not None:
+            self._stats["hits"] += 1
+            return entry
+        self._stats["misses"] += 1
+
+        try:
+            if JWT_VERIFY_SIGNATURE:
+                header = jwt.get_unverified_header(token)
+                key = await self._signing_key(header.get("kid"))
+                claims = jwt.decode(
+                    token,
+                    key.key,
+                    algorithms=JWT_ALGORITHMS,
+                    audience=JWT_AUDIENCE,
+                    issuer=JWT_ISSUER,
+                    options={"require": ["exp"], "verify_aud": JWT_AUDIENCE is not None},
+                )
+            else:
+                claims = jwt.decode(token, options={"verify_signature": False})
+        except jwt.InvalidTokenError:
+            self._stats["rejected"] += 1
+            raise
+
+        derived = self.derive(claims) if self.derive else None
+        if TOKEN_CACHE_SIZE > 0:
+            self._claims[hashlib.sha256(token.encode()).digest()] = (claims, derived, claims.get("exp"))
+            while len(self._claims) > TOKEN_CACHE_SIZE:
+                self._claims.popitem(last=False)
+        return claims, derived
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "size": len(self._claims),
+            "signing_keys": len(self._keys),
+            "verify_signature": JWT_VERIFY_SIGNATURE,
+        }
+
+
 class ZeroTrustMCPServer:
     def __init__(self):
         self.server = Server("zerotrust-mcp")
         self.http_client = httpx.AsyncClient(timeout=30.0)
+        self.token_verifier = TokenVerifier(KEYCLOAK_JWKS_URL, self.http_client)
         
     def decode_token(self, token: str):
-        """Decode JWT token without verification (for user info display only)"""
+        """Return verified claims cached by validate_authentication (display-only decode otherwise)"""
+        entry = self.token_verifier.cached(token)
+        if entry is not None:
+            return entry[0]
         return jwt.decode(token, options={"verify_signature": False})
     
-    def validate_authentication(self, token: str) -> bool:
-        """Validate that a JWT token is present and properly formatted"""
+    async def validate_authentication(self, token: str) -> bool:
+        """Validate the JWT signature and expiry against Keycloak's signing keys"""
         if not token:
             return False
         try:
-            # Basic token format validation
-            self.decode_token(token)
+            await self.token_verifier.verify(token)
             return True
-        except:
+        except Exception as e:
+            logger.warning(f"Token rejected: {e}")
             return False
     
-    async def call_middleware(self, token: str, payload: dict) -> dict:
+    async def call_middleware(self, token: str, payload: dict, url: str = MIDDLEWARE_URL) -> dict:
         """Call middleware with JWT token and payload"""
         headers = {"Authorization": f"Bearer {token}"}
         
         try:
-            response = await self.http_client.post(MIDDLEWARE_URL, json=payload, headers=headers)
+            response = await self.http_client.post(url, json=payload, headers=headers)
             
             if response.status_code == 200:
                 return {"success": True, "data": response.json()}
@@ -131,9 +256,18 @@ class ZeroTrustMCPServer:
                                     "enum": ["read", "write"],
                                     "default": "read", 
                                     "description": "Action type"
+                                },
+                                "page_size": {
+                                    "type": "integer",
+                                    "minimum": 1,
+                                    "description": "Return results in pages of this many rows"
+                                },
+                                "cursor": {
+                                    "type": "string",
+                                    "description": "Continuation cursor from a previous page; replaces query, database, resource and action"
                                 }
                             },
-                            "required": ["token", "query", "database"]
+                            "required": ["token"]
                         }
                     ),
                     Tool(
@@ -169,6 +303,35 @@ class ZeroTrustMCPServer:
                             "required": ["token", "resource", "database", "action"]
                         }
                     ),
+                    Tool(
+                        name="get_permission_matrix",
+                        description="Check every database/resource/action combination for a user in one call",
+                        inputSchema={
+                            "type": "object",
+                            "properties": {
+                                "token": {
+                                    "type": "string",
+                                    "description": "JWT authentication token"
+                                },
+                                "databases": {
+                                    "type": "array",
+                                    "items": {"type": "string", "enum": ["us_db", "eu_db", "sandbox_db"]},
+                                    "description": "Databases to include (default: all)"
+                                },
+                                "resources": {
+                                    "type": "array",
+                                    "items": {"type": "string", "enum": ["patients", "notes"]},
+                                    "description": "Resources to include (default: all)"
+                                },
+                                "actions": {
+                                    "type": "array",
+                                    "items": {"type": "string", "enum": ["read", "write"]},
+                                    "description": "Actions to include (default: all)"
+                                }
+                            },
+                            "required": ["token"]
+                        }
+                    ),
                     Tool(
                         name="get_user_info",
                         description="Get user information from JWT token",
@@ -203,6 +366,8 @@ class ZeroTrustMCPServer:
                     return await self._query_database(request.arguments)
                 elif request.name == "check_authorization":
                     return await self._check_authorization(request.arguments)
+                elif request.name == "get_permission_matrix":
+                    return await self._get_permission_matrix(request.arguments)
                 elif request.name == "get_user_info":
                     return await self._get_user_info(request.arguments)
                 elif request.name == "list_databases":
@@ -225,12 +390,14 @@ class ZeroTrustMCPServer:
         resource = args.get("resource", "patients")
         action = args.get("action", "read")
         patient_id = args.get("patient_id")
+        page_size = args.get("page_size")
+        cursor = args.get("cursor")
         
-        if not all([token, query, database]):
-            raise ValueError("Missing required parameters: token, query, database")
+        if not token or not (cursor or (query and database)):
+            raise ValueError("Missing required parameters: token, query, database (or cursor)")
         
         # Authentication required - no anonymous access
-        if not self.validate_authentication(token):
+        if not await self.validate_authentication(token):
             return CallToolResult(
                 content=[
                     TextContent(
@@ -249,7 +416,7 @@ class ZeroTrustMCPServer:
         
         # Valid databases
         valid_dbs = ["us_db", "eu_db", "sandbox_db"]
-        if database not in valid_dbs:
+        if not cursor and database not in valid_dbs:
             raise ValueError(f"Unknown database: {database}. Valid options: {', '.join(valid_dbs)}")
         
         try:
@@ -269,10 +436,15 @@ class ZeroTrustMCPServer:
                 payload["patient_id"] = patient_id
             
             # Check if it's a natural language query or direct SQL
-            if query.strip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+            if cursor:
+                # The middleware restores the original query and context from the cursor
+                payload = {"cursor": cursor}
+            elif query.strip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
                 payload["sql"] = query
             else:
                 payload["natural_language"] = query
+            if page_size and not cursor:
+                payload["page_size"] = page_size
             
             logger.info(f"Proxying query for {username} to middleware: {payload}")
             
@@ -287,9 +459,12 @@ class ZeroTrustMCPServer:
                 
                 result_text = f"✅ Query executed successfully!\n\n"
                 result_text += f"User: {username}\n"
-                result_text += f"Database: {database}\n"
+                result_text += f"Database: {database or '(continued from cursor)'}\n"
                 result_text += f"Generated SQL: {sql}\n"
-                result_text += f"Results: {len(rows)} rows returned\n\n"
+                result_text += f"Results: {len(rows)} rows returned\n"
+                if data.get("next_cursor"):
+                    result_text += f"Next page cursor: {data['next_cursor']}\n"
+                result_text += "\n"
                 
                 if rows:
                     # Format rows for better display
@@ -347,7 +522,7 @@ class ZeroTrustMCPServer:
             )
 
     async def _check_authorization(self, args: Dict[str, Any]) -> CallToolResult:
-        """Check authorization by making a test call to middleware"""
+        """Check authorization with a decision-only call to middleware"""
         token = args.get("token")
         resource = args.get("resource")
         database = args.get("database")
@@ -358,7 +533,7 @@ class ZeroTrustMCPServer:
             raise ValueError("Missing required parameters: token, resource, database, action")
         
         # Authentication required
-        if not self.validate_authentication(token):
+        if not await self.validate_authentication(token):
             return CallToolResult(
                 content=[
                     TextContent(
@@ -378,16 +553,19 @@ class ZeroTrustMCPServer:
             roles = user_data.get("realm_access", {}).get("roles", [])
             role = roles[0] if roles else "unknown"
             
-            # Make a test call to middleware with a simple query to check authorization
+            # Ask the middleware for the policy decision only - no query is executed
             payload = {
                 "resource": resource,
                 "db": database,
                 "action": action,
-                "patient_id": patient_id,
-                "sql": "SELECT 1"  # Simple test query
+                "patient_id": patient_id
             }
             
-            result = await self.call_middleware(token, payload)
+            result = await self.call_middleware(token, payload, url=MIDDLEWARE_AUTHZ_URL)
+            if result["success"]:
+                role = result["data"].get("role", role)
+                if not result["data"].get("allowed"):
+                    result = {"success": False, "error": "Access denied", "status": 403}
             
             if result["success"]:
                 return CallToolResult(
@@ -453,6 +631,73 @@ class ZeroTrustMCPServer:
                 isError=True
             )
 
+    async def _get_permission_matrix(self, args: Dict[str, Any]) -> CallToolResult:
+        """Build a permission matrix with a single batch call to middleware"""
+        token = args.get("token")
+        if not token:
+            raise ValueError("Missing required parameter: token")
+        
+        # Authentication required
+        if not await self.validate_authentication(token):
+            return CallToolResult(
+                content=[
+                    TextContent(
+                        type="text",
+                        text="AUTHENTICATION REQUIRED\n\n"
+                             "Permission checks require valid JWT authentication.\n"
+                             "Please provide a valid token to check permissions."
+                    )
+                ],
+                isError=True
+            )
+        
+        databases = args.get("databases") or ["us_db", "eu_db", "sandbox_db"]
+        resources = args.get("resources") or ["patients", "notes"]
+        actions = args.get("actions") or ["read", "write"]
+        checks = [
+            {"resource": resource, "db": database, "action": action}
+            for database in databases
+            for resource in resources
+            for action in actions
+        ]
+        
+        user_data = self.decode_token(token)
+        username = user_data.get("preferred_username", "unknown")
+        result = await self.call_middleware(token, {"checks": checks}, url=MIDDLEWARE_AUTHZ_URL)
+        if not result["success"]:
+            return CallToolResult(
+                content=[
+                    TextContent(
+                        type="text",
+                        text=f"💥 Permission matrix error\n\nUser: {username}\n\nError: {result['error']}"
+                    )
+                ],
+                isError=True
+            )
+        
+        data = result["data"]
+        allowed = {
+            (d["db"], d["resource"], d["action"]): d["allowed"]
+            for d in data.get("decisions", [])
+        }
+        header = ["Database"] + [f"{resource}:{action}" for resource in resources for action in actions]
+        lines = [" | ".join(header)]
+        for database in databases:
+            cells = ["✅" if allowed.get((database, resource, action)) else "❌"
+                     for resource in resources for action in actions]
+            lines.append(" | ".join([database] + cells))
+        
+        return CallToolResult(
+            content=[
+                TextContent(
+                    type="text",
+                    text=f"🔐 Permission Matrix\n\n"
+                         f"User: {username} (Role: {data.get('role', 'unknown')})\n\n"
+                         + "\n".join(lines)
+                )
+            ]
+        )
+
     async def _get_user_info(self, args: Dict[str, Any]) -> CallToolResult:
         """Extract user information from JWT token"""
         token = args.get("token")
@@ -460,7 +705,7 @@ class ZeroTrustMCPServer:
             raise ValueError("Missing required parameter: token")
         
         # Authentication required
-        if not self.validate_authentication(token):
+        if not await self.validate_authentication(token):
             return CallToolResult(
                 content=[
                     TextContent(
@@ -473,10 +718,9 @@ class ZeroTrustMCPServer:
                 isError=True
             )
         
-        # Decode JWT without verification (same as middleware does)
-        import jwt
+        # Claims were verified and cached by validate_authentication
         try:
-            user_data = jwt.decode(token, options={"verify_signature": False})
+            user_data = self.decode_token(token)
             
             # Extract key information
             username = user_data.get("preferred_username", "Unknown")
@@ -588,6 +832,8 @@ async def mcp_call_endpoint(request: Request):
             result = await mcp_server_instance._query_database(parameters)
         elif tool_name == "check_authorization":
             result = await mcp_server_instance._check_authorization(parameters)
+        elif tool_name == "get_permission_matrix":
+            result = await mcp_server_instance._get_permission_matrix(parameters)
         elif tool_name == "get_user_info":
             result = await mcp_server_instance._get_user_info(parameters)
         elif tool_name == "list_databases":
@@ -0,0 +1,236 @@
+"""Unit tests for the middleware's pure SQL rewriting and generation helpers.
+
+Nothing here needs a database, OPA or Ollama; run with ``pytest`` from this directory.
+"""
+import pytest
+
+import app
+
+
+# --- Literal lifting for prepared statements (sql_shape) ---
+
+@pytest.mark.parametrize("sql, shape, params", [
+    ("SELECT * FROM patients WHERE id = 'p1' AND age > 40 LIMIT 5",
+     "SELECT * FROM patients WHERE id = $1 AND age > $2 LIMIT $3", ["p1", 40, 5]),
+    ("SELECT * FROM t WHERE name = 'O''Brien'", "SELECT * FROM t WHERE name = $1", ["O'Brien"]),
+    ("SELECT * FROM t WHERE s LIKE 'a%' OFFSET 10", "SELECT * FROM t WHERE s LIKE $1 OFFSET $2", ["a%", 10]),
+    ("SELECT * FROM t WHERE x <> -3", "SELECT * FROM t WHERE x <> $1", [-3]),
+    # Quoted identifiers stay; the comparison against them is still lifted
+    ('SELECT * FROM t WHERE "x=1" = 1', 'SELECT * FROM t WHERE "x=1" = $1', [1]),
+])
+def test_sql_shape_lifts_literals(sql, shape, params):
+    assert app.sql_shape(sql) == (shape, params)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT 'x' AS label, id FROM t",                          # projected literal changes the result shape
+    "SELECT * FROM t WHERE a IN ('a', 'b')",                   # list arity would be part of the shape
+    "SELECT * FROM t WHERE created_at > now() - interval '1 day'",  # typed literal
+    "SELECT * FROM t WHERE x = 3.5",                           # non-integer numbers keep their type
+    "SELECT * FROM t WHERE a = $1",                            # already parameterized
+    "SELECT $$x = 1$$",                                        # dollar quoting
+])
+def test_sql_shape_leaves_other_literals(sql):
+    assert app.sql_shape(sql) == (sql, [])
+
+
+def test_sql_shape_same_shape_for_different_values():
+    first, _ = app.sql_shape("SELECT * FROM notes WHERE patient_id = 'p001' LIMIT 20")
+    second, _ = app.sql_shape("SELECT * FROM notes WHERE patient_id = 'p002' LIMIT 50")
+    assert app.shape_fingerprint(first) == app.shape_fingerprint(second)
+
+
+# --- Schema validation of generated SQL (validate_sql) ---
+
+VALIDATION_DIGEST = {"tables": {"patients": [["id", "text"], ["status", "text"]],
+                                "notes": [["id", "integer"], ["patient_id", "text"]]}}
+
+
+@pytest.fixture
+def validate(monkeypatch):
+    monkeypatch.setattr(app.schema_catalog, "get", lambda db: VALIDATION_DIGEST)
+    return lambda sql: app.validate_sql("us_db", sql)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM \"patients\" WHERE status = 'active'",
+    "SELECT p.id FROM \"patients\" AS p JOIN notes n ON n.patient_id = p.id",
+    "SELECT * FROM \"Patients\"",                               # case-sensitive name: left to EXPLAIN
+    "SELECT * FROM patients WHERE status = 'from nowhere join x'",
+    "SELECT \"p\".\"id\" FROM patients p",
+])
+def test_validate_sql_accepts(validate, sql):
+    validate(sql)
+
+
+@pytest.mark.parametrize("sql, message", [
+    ("SELECT * FROM \"patient\" WHERE status = 'active'", "unknown table patient"),
+    ("SELECT * FROM sessions", "unknown table sessions"),
+    ("SELECT p.age FROM patients p", "unknown column p.age"),
+])
+def test_validate_sql_rejects(validate, sql, message):
+    with pytest.raises(app.InvalidSQL, match=message):
+        validate(sql)
+
+
+# --- Intent tier (IntentEngine._match) ---
+
+INTENT_DIGEST = {
+    "tables": {
+        "patients": [["id", "text"], ["name", "text"], ["region", "text"], ["assigned_therapist", "text"],
+                     ["status", "text"], ["diagnosis_category", "text"], ["created_at", "timestamp"]],
+        "notes": [["id", "integer"], ["patient_id", "text"], ["therapist_id", "text"], ["author", "text"],
+                  ["note", "text"], ["created_at", "timestamp"]],
+        "therapists": [["id", "text"], ["name", "text"], ["active", "boolean"]],
+    },
+}
+INTENT_VALUES = {
+    ("patients", "id"): ["p001", "p002"],
+    ("patients", "region"): ["us", "eu"],
+    ("patients", "assigned_therapist"): ["sarah_therapist", "mike_therapist"],
+    ("patients", "status"): ["active", "inactive"],
+    ("patients", "diagnosis_category"): ["anxiety", "depression", "eating_disorder"],
+    ("notes", "patient_id"): ["p001", "p002"],
+    ("notes", "therapist_id"): ["sarah_therapist", "mike_therapist"],
+    ("notes", "author"): ["sarah_therapist"],
+    ("therapists", "id"): ["sarah_therapist", "mike_therapist"],
+}
+
+
+@pytest.fixture
+def intent():
+    engine = app.IntentEngine()
+    compiled = engine._compile(INTENT_DIGEST, INTENT_VALUES)
+    return lambda question, resource="patients": engine._match(compiled, app.intent_tokens(question), resource)
+
+
+@pytest.mark.parametrize("question, resource, sql", [
+    ("active patients for sarah_therapist", "patients",
+     "SELECT * FROM patients WHERE status = 'active' AND assigned_therapist = 'sarah_therapist' LIMIT 20"),
+    ("notes for patient p1", "notes", "SELECT * FROM notes WHERE patient_id = 'p001' LIMIT 20"),
+    ("count patients by status", "patients",
+     "SELECT status, COUNT(*) AS count FROM patients GROUP BY status ORDER BY count DESC"),
+    ("how many active or inactive patients", "patients",
+     "SELECT COUNT(*) AS count FROM patients WHERE status IN ('active', 'inactive')"),
+    ("latest 3 notes", "notes", "SELECT * FROM notes ORDER BY created_at DESC LIMIT 3"),
+    ("patients with eating disorder", "patients",
+     "SELECT * FROM patients WHERE diagnosis_category = 'eating_disorder' LIMIT 20"),
+    ("patients in region us", "patients", "SELECT * FROM patients WHERE region = 'us' LIMIT 20"),
+])
+def test_intent_matches(intent, question, resource, sql):
+    assert intent(question, resource) == sql
+
+
+@pytest.mark.parametrize("question, resource", [
+    ("patients older than 40", "patients"),             # unknown words
+    ("count active therapists", "therapists"),          # boolean column named, no filter for it
+    ("therapists who are active", "therapists"),
+    ("show patient names", "patients"),                 # projection the tier can't express
+    ("give us the active patients", "patients"),        # 'us' is a region only after "region"
+    ("notes for sarah_therapist", "notes"),             # value in two columns, no hint
+    ("patients by status", "patients"),                 # grouping without a count
+    ("patients with their notes", "patients"),          # second table needs a join
+    ("notes for patient p1", "patients"),               # only the authorized resource is queried
+    ("list therapists", "patients"),
+    ("count patients", "billing"),                      # resource without a table
+])
+def test_intent_misses(intent, question, resource):
+    assert intent(question, resource) is None
+
+
+def test_intent_column_hint_settles_ambiguous_value(intent):
+    assert intent("notes by therapist sarah_therapist", "notes") is None  # "by therapist" is a grouping
+    assert intent("notes for therapist sarah_therapist", "notes") == \
+        "SELECT * FROM notes WHERE therapist_id = 'sarah_therapist' LIMIT 20"
+
+
+def test_intent_literals_are_quoted(intent):
+    engine = app.IntentEngine()
+    compiled = engine._compile(INTENT_DIGEST, {("patients", "name"): ["O'Brien"]})
+    assert engine._match(compiled, app.intent_tokens("patients named o'brien"), "patients") is None
+    assert engine._match(compiled, app.intent_tokens("patients with name o'brien"), "patients") == \
+        "SELECT * FROM patients WHERE name = 'O''Brien' LIMIT 20"
+
+
+@pytest.mark.parametrize("n_distinct, reltuples, size, expected", [
+    (5, 1000, 10 ** 9, True),              # few distinct values, however big the table
+    (-1.0, 10 ** 6, 10 ** 9, False),       # unique per row: free text or ids
+    (-0.0001, 10 ** 6, 10 ** 9, True),     # 100 distinct values as a fraction
+    (None, -1, 8192, True),                # never analyzed, small table
+    (None, -1, 10 ** 9, False),            # never analyzed, large table
+])
+def test_intent_candidate_columns(n_distinct, reltuples, size, expected):
+    assert app.intent_candidate(n_distinct, reltuples, size) is expected
+
+
+# --- Federation planning and merging (plan_federated / merge_partials / order_federated) ---
+
+def partial(plan, rows):
+    """A region's result for ``plan['region_sql']``, with the pN column names it produces"""
+    columns = []
+    for i, item in enumerate(plan["items"]):
+        columns += [f"p{i}", f"p{i}_n"] if item["func"] == "avg" else [f"p{i}"]
+    return {"columns": columns, "type_codes": [None] * len(columns), "rows": rows}
+
+
+def test_federated_aggregate_rewrite():
+    plan = app.plan_federated("SELECT status AS s, COUNT(*), AVG(age) FROM patients WHERE region <> 'x' "
+                              "GROUP BY s ORDER BY 2 DESC LIMIT 5")
+    assert plan["mode"] == "aggregate"
+    assert plan["region_sql"] == ("SELECT status AS p0, COUNT(*) AS p1, SUM(age) AS p2, COUNT(age) AS p2_n "
+                                  "FROM patients WHERE region <> 'x' GROUP BY 1")
+    assert [item["name"] for item in plan["items"]] == ["s", "count", "avg"]
+
+
+def test_federated_merge_groups_avg_and_null_sum():
+    plan = app.plan_federated("SELECT status, COUNT(*), SUM(score), AVG(age), MIN(age) FROM patients GROUP BY status")
+    us = partial(plan, [("active", 3, None, 90, 3, 20), ("inactive", 1, 5, 40, 1, 40)])
+    eu = partial(plan, [("active", 1, None, 50, 1, 18)])
+    rows, _ = app.merge_partials(plan, [us, eu])
+    by_status = {row[0]: row for row in rows}
+    # AVG is re-derived from the summed partials, not averaged averages
+    assert by_status["active"] == ["active", 4, None, 35, 18]
+    assert by_status["inactive"] == ["inactive", 1, 5, 40, 40]
+
+
+def test_federated_merge_empty_regions():
+    plan = app.plan_federated("SELECT COUNT(*), AVG(age) FROM patients")
+    rows, _ = app.merge_partials(plan, [partial(plan, [(0, None, 0)]), partial(plan, [(0, None, 0)])])
+    assert rows == [[0, None]]
+
+
+@pytest.mark.parametrize("sql, reason", [
+    ("SELECT status, COUNT(*) FROM patients GROUP BY region", "GROUP BY"),
+    ("SELECT COUNT(DISTINCT region) FROM patients", "DISTINCT"),
+    ("SELECT status, COUNT(*) FROM patients GROUP BY status HAVING COUNT(*) > 1", "HAVING"),
+    ("SELECT status, COUNT(*) FROM patients GROUP BY status ORDER BY created_at", "ORDER BY"),
+    ("SELECT DISTINCT region FROM patients ORDER BY name", "ORDER BY"),
+    ("SELECT string_agg(name, ',') FROM patients", "combined"),
+])
+def test_federated_unsupported(sql, reason):
+    with pytest.raises(app.FederationUnsupported, match=reason):
+        app.plan_federated(sql)
+
+
+def test_federated_rows_order_by_unselected_column():
+    plan = app.plan_federated("SELECT name FROM patients ORDER BY created_at DESC LIMIT 3")
+    assert plan["mode"] == "rows"
+    assert plan["region_sql"] == "SELECT name, created_at AS __order_0 FROM patients ORDER BY created_at DESC LIMIT 3"
+    assert plan["hidden"] == 1
+    # The second region's newer rows must win the merged top 3
+    rows = [["a", 3], ["b", 2], ["c", 1], ["d", 5], ["e", 4], ["f", 0]]
+    assert app.order_federated(plan, ["name", "__order_0"], rows)
+    assert [row[0] for row in rows[:3]] == ["d", "e", "a"]
+
+
+def test_federated_rows_limit_covers_offset():
+    plan = app.plan_federated("SELECT id, name FROM patients ORDER BY id LIMIT 10 OFFSET 5")
+    assert plan["region_sql"] == "SELECT id, name FROM patients ORDER BY id LIMIT 15"
+    assert plan["hidden"] == 0
+
+
+def test_federated_order_nulls():
+    plan = app.plan_federated("SELECT id, score FROM patients ORDER BY score DESC NULLS LAST")
+    rows = [["a", None], ["b", 1], ["c", 2]]
+    assert app.order_federated(plan, ["id", "score"], rows)
+    assert [row[0] for row in rows] == ["c", "b", "a"]
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Middleware concurrency benchmark
+Fires the same /query request at increasing levels of in-flight concurrency
+and reports throughput and latency for each level, so throughput scaling
+with in-flight requests can be compared before and after changes.
+
+Usage:
+    ./scripts/bench-concurrency.py --user sarah_therapist --levels 1,8,32,128,256
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+
+import httpx
+
+KEYCLOAK_TOKEN_URL = os.getenv(
+    "KEYCLOAK_TOKEN_URL", "http://localhost:8080/realms/zerotrust/protocol/openid-connect/token"
+)
+
+
+async def get_token(client: httpx.AsyncClient, username: str, password: str) -> str:
+    """Fetch an access token from Keycloak using the demo-ui client"""
+    resp = await client.post(KEYCLOAK_TOKEN_URL, data={
+        "grant_type": "password",
+        "client_id": "demo-ui",
+        "username": username,
+        "password": password,
+    })
+    resp.raise_for_status()
+    return resp.json()["access_token"]
+
+
+async def run_level(client: httpx.AsyncClient, url: str, headers: dict, payload: dict,
+                    concurrency: int, total: int) -> dict:
+    """Send ``total`` requests keeping ``concurrency`` of them in flight"""
+    latencies = []
+    errors = 0
+    remaining = iter(range(total))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            start = time.perf_counter()
+            try:
+                resp = await client.post(url, json=payload, headers=headers)
+                if resp.status_code != 200:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8001/query", help="Query endpoint to benchmark")
+    parser.add_argument("--token", default=os.getenv("BENCH_TOKEN"), help="JWT to use (fetched from Keycloak if omitted)")
+    parser.add_argument("--user", default="sarah_therapist", help="Keycloak user to fetch a token for")
+    parser.add_argument("--password", default="password", help="Keycloak password")
+    parser.add_argument("--levels", default="1,8,32,128,256", help="Comma separated in-flight request counts")
+    parser.add_argument("--requests-per-level", type=int, default=0,
+                        help="Requests sent per level (default: 4x the concurrency, at least 50)")
+    parser.add_argument("--db", default="us_db")
+    parser.add_argument("--resource", default="patients")
+    parser.add_argument("--sql", default="SELECT * FROM patients LIMIT 10")
+    parser.add_argument("--natural-language", help="Send a natural language query instead of --sql")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(",") if level.strip()]
+    payload = {"db": args.db, "resource": args.resource, "action": "read"}
+    if args.natural_language:
+        payload["natural_language"] = args.natural_language
+    else:
+        payload["sql"] = args.sql
+
+    limits = httpx.Limits(max_connections=max(levels), max_keepalive_connections=max(levels))
+    async with httpx.AsyncClient(timeout=120.0, limits=limits) as client:
+        token = args.token or await get_token(client, args.user, args.password)
+        headers = {"Authorization": f"Bearer {token}"}
+
+        # Warm up connections and caches before measuring
+        await run_level(client, args.url, headers, payload, 1, 5)
+
+        results = []
+        for level in levels:
+            total = args.requests_per_level or max(50, level * 4)
+            results.append(await run_level(client, args.url, headers, payload, level, total))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'in-flight':>9} {'requests':>8} {'errors':>6} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for r in results:
+        print(f"{r['concurrency']:>9} {r['requests']:>8} {r['errors']:>6} {r['throughput_rps']:>8} "
+              f"{r['p50_ms']:>8} {r['p95_ms']:>8} {r['max_ms']:>8}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
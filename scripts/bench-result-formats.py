@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Result format benchmark
+Compares the JSON /query response path against the Arrow IPC stream format
+for synthetic results shaped like sandbox_db notes, reporting encode time,
+decode time and payload size at each result size.
+
+JSON is timed the way it travels today: FastAPI encoding in the middleware,
+decode and re-encode in the agent, and decode in the client. Arrow is encoded
+once by the middleware (using its own encoder), relayed untouched by the agent
+and decoded by the client.
+
+With --dsn, also measures middleware CPU for plain JSON /query results against
+a real Postgres: rows fetched and encoded in Python (execute_with_fallback +
+FastAPI's encoder) versus the body rendered by Postgres (execute_as_json).
+Both run the middleware's own functions over a temporary notes-shaped table;
+CPU is this process's time, so Postgres' share is excluded.
+
+Usage:
+    ./scripts/bench-result-formats.py --rows 10000,100000,1000000
+    ./scripts/bench-result-formats.py --rows 100000 --dsn postgresql://postgres@localhost/sandbox_db
+"""
+
+import argparse
+import datetime
+import decimal
+import json
+import os
+import random
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.ipc
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "middleware"))
+from app import ConnectionPool, encode_arrow, encode_result, execute_as_json, execute_with_fallback  # noqa: E402
+
+NOTES_COLUMNS = ["id", "patient_id", "session_number", "note_category", "sentiment_score", "word_count", "created_at"]
+# Postgres type OIDs as reported in cursor.description for the notes table
+NOTES_TYPE_CODES = [23, 1043, 23, 1043, 1700, 23, 1114]
+CATEGORIES = ["intake", "progress", "assessment", "discharge"]
+
+
+def make_result(count: int) -> dict:
+    """Build a result dict as returned by execute_with_fallback"""
+    rng = random.Random(count)
+    start = datetime.datetime(2026, 1, 1)
+    rows = [
+        (
+            i,
+            f"anon_{rng.randint(1, 500):03d}",
+            rng.randint(1, 40),
+            rng.choice(CATEGORIES),
+            decimal.Decimal(rng.randint(-99, 99)).scaleb(-2),
+            rng.randint(50, 2000),
+            start + datetime.timedelta(seconds=rng.randint(0, 86400 * 300)),
+        )
+        for i in range(1, count + 1)
+    ]
+    return {"rows": rows, "columns": NOTES_COLUMNS, "type_codes": NOTES_TYPE_CODES, "sql": "SELECT * FROM notes"}
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    value = fn(*args)
+    return value, time.perf_counter() - start
+
+
+def dump_json(content) -> bytes:
+    # Same settings as starlette.responses.JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode()
+
+
+def bench_json(result: dict) -> dict:
+    def middleware_encode():
+        payload = {"rows": [list(row) for row in result["rows"]], "columns": result["columns"], "sql": result["sql"]}
+        return dump_json(jsonable_encoder(payload))
+
+    body, encode_s = timed(middleware_encode)
+    _, agent_s = timed(lambda: dump_json(jsonable_encoder(json.loads(body))))
+    _, decode_s = timed(json.loads, body)
+    return {"format": "json", "bytes": len(body), "encode_ms": encode_s * 1000,
+            "agent_ms": agent_s * 1000, "decode_ms": decode_s * 1000}
+
+
+def bench_arrow(result: dict) -> dict:
+    body, encode_s = timed(encode_arrow, result)
+    _, decode_s = timed(lambda: pa.ipc.open_stream(body).read_all())
+    return {"format": "arrow", "bytes": len(body), "encode_ms": encode_s * 1000,
+            "agent_ms": 0.0, "decode_ms": decode_s * 1000}
+
+
+NOTES_TABLE_SQL = """
+CREATE TEMP TABLE bench_notes AS
+SELECT i AS id, 'anon_' || lpad((i %% 500)::text, 3, '0') AS patient_id, (i %% 40) + 1 AS session_number,
+       (ARRAY['intake', 'progress', 'assessment', 'discharge'])[(i %% 4) + 1] AS note_category,
+       round(((i %% 199) - 99) / 100.0, 2) AS sentiment_score, 50 + (i %% 1950) AS word_count,
+       timestamp '2026-01-01' + (i %% 25920000) * interval '1 second' AS created_at
+FROM generate_series(1, %s) AS i
+"""
+
+
+def cpu_timed(fn, *args):
+    cpu, wall = time.process_time(), time.perf_counter()
+    value = fn(*args)
+    return value, (time.process_time() - cpu) * 1000, (time.perf_counter() - wall) * 1000
+
+
+def bench_pg_json(dsn: str, count: int, repeat: int = 3) -> list:
+    """Middleware CPU for one JSON /query response, Python encoder vs Postgres-rendered"""
+    pool = ConnectionPool("bench", dsn, min_size=0, max_size=1)
+    conn = pool.getconn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP TABLE IF EXISTS bench_notes")
+            cur.execute(NOTES_TABLE_SQL, (count,))
+        conn.commit()
+        sql = "SELECT * FROM bench_notes"
+
+        def python_path():
+            result = encode_result(execute_with_fallback(pool, conn, sql, {}), "json")
+            return dump_json(jsonable_encoder(result))
+
+        def postgres_path():
+            return execute_as_json(pool, conn, sql)["body"]
+
+        results = []
+        for name, path in (("python", python_path), ("postgres", postgres_path)):
+            path()  # warm up prepared statements and caches
+            runs = [cpu_timed(path) for _ in range(repeat)]
+            body, cpu_ms, wall_ms = min(runs, key=lambda run: run[1])
+            results.append({"rows": count, "encoder": name, "bytes": len(body), "cpu_ms": cpu_ms, "wall_ms": wall_ms,
+                            "cpu_ms_per_100k": cpu_ms * 100000 / count})
+        return results
+    finally:
+        pool.putconn(conn)
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", default="10000,100000,1000000", help="Comma separated result sizes")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--dsn", help="Postgres DSN; adds the Python vs Postgres JSON encoder comparison")
+    args = parser.parse_args()
+    counts = [int(c) for c in args.rows.split(",") if c.strip()]
+
+    results = []
+    for count in counts:
+        result = make_result(count)
+        for measurement in (bench_json(result), bench_arrow(result)):
+            measurement["rows"] = count
+            results.append(measurement)
+
+    pg_results = [r for count in counts for r in bench_pg_json(args.dsn, count)] if args.dsn else []
+
+    if args.json:
+        print(json.dumps(results + pg_results, indent=2))
+        return
+
+    print(f"{'rows':>9} {'format':>6} {'MB':>8} {'encode ms':>10} {'agent ms':>9} {'decode ms':>10} {'total ms':>9}")
+    for r in results:
+        total = r["encode_ms"] + r["agent_ms"] + r["decode_ms"]
+        print(f"{r['rows']:>9} {r['format']:>6} {r['bytes'] / 1e6:>8.2f} {r['encode_ms']:>10.1f} "
+              f"{r['agent_ms']:>9.1f} {r['decode_ms']:>10.1f} {total:>9.1f}")
+
+    if pg_results:
+        print(f"\n{'rows':>9} {'encoder':>9} {'MB':>8} {'cpu ms':>9} {'wall ms':>9} {'cpu ms/100k':>12}")
+        for r in pg_results:
+            print(f"{r['rows']:>9} {r['encoder']:>9} {r['bytes'] / 1e6:>8.2f} {r['cpu_ms']:>9.1f} "
+                  f"{r['wall_ms']:>9.1f} {r['cpu_ms_per_100k']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
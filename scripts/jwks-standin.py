@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Local JWKS stand-in for Keycloak
+Generates an RSA signing key, serves it as a JWKS document and mints signed
+tokens, so JWT verification in the middleware and MCP server can be tested
+without a running Keycloak.
+
+Usage:
+    ./scripts/jwks-standin.py --port 8089
+    KEYCLOAK_JWKS_URL=http://localhost:8089/certs uvicorn app:app --port 8001
+    curl "http://localhost:8089/token?username=sarah_therapist&role=therapist"
+
+Hitting /rotate replaces the signing key with a new kid to exercise key rotation.
+"""
+
+import argparse
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+class SigningKey:
+    def __init__(self):
+        self.rotate()
+
+    def rotate(self):
+        self.kid = uuid.uuid4().hex[:12]
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+    def jwks(self) -> dict:
+        jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        jwk.update({"kid": self.kid, "use": "sig", "alg": "RS256"})
+        return {"keys": [jwk]}
+
+    def mint(self, username: str, role: str, ttl: int) -> str:
+        now = int(time.time())
+        claims = {
+            "sub": username,
+            "preferred_username": username,
+            "realm_access": {"roles": [role, "default-roles-zerotrust"]},
+            "iat": now,
+            "exp": now + ttl,
+        }
+        return jwt.encode(claims, self.private_key, algorithm="RS256", headers={"kid": self.kid})
+
+
+def make_handler(key: SigningKey):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, body, content_type="application/json"):
+            data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == "/certs":
+                self._send(key.jwks())
+            elif url.path == "/token":
+                token = key.mint(
+                    params.get("username", "sarah_therapist"),
+                    params.get("role", "therapist"),
+                    int(params.get("ttl", "3600")),
+                )
+                self._send(token, "text/plain")
+            elif url.path == "/rotate":
+                key.rotate()
+                self._send({"kid": key.kid})
+            else:
+                self.send_error(404)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8089)
+    args = parser.parse_args()
+
+    key = SigningKey()
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(key))
+    print(f"JWKS stand-in listening on http://{args.host}:{args.port} (kid={key.kid})")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()